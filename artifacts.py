@@ -0,0 +1,171 @@
+# artifacts.py
+import json
+import os
+import threading
+import time
+
+from config import config
+
+
+class ArtifactStore:
+    """Track derived and archived files and keep each class within its byte budget.
+
+    Every artifact is recorded with its class, size and last access time.
+    When a regenerable class goes over its configured budget the least
+    recently used files in that class are deleted. Paths that were evicted
+    are remembered so callers can regenerate them on demand instead of
+    eagerly. Classes that can't be regenerated only have their usage reported.
+    """
+
+    SAVE_INTERVAL = 60  # Seconds between index writes caused only by access touches
+
+    def __init__(self, index_file, regenerable=()):
+        self.index_file = index_file
+        self.regenerable = set(regenerable)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._evicted = set()
+        self._last_save = 0
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        """Load the persisted index, starting empty if it is missing or corrupt."""
+        try:
+            with open(self.index_file, 'r') as f:
+                data = json.load(f)
+            self._entries = data.get("entries", {})
+            self._evicted = set(data.get("evicted", []))
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._entries = {}
+            self._evicted = set()
+
+    def _save(self):
+        """Persist the index. Caller must hold the lock."""
+        directory = os.path.dirname(self.index_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write to a temp file and rename so a crash never leaves a corrupt index
+        tmp_path = f"{self.index_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"entries": self._entries, "evicted": sorted(self._evicted)}, f)
+        os.replace(tmp_path, self.index_file)
+        self._last_save = time.time()
+        self._dirty = False
+
+    def scan(self, artifact_class, directory, extensions):
+        """Pick up files already on disk that the index doesn't know about."""
+        if not os.path.isdir(directory):
+            return
+        with self._lock:
+            for filename in os.listdir(directory):
+                if not filename.lower().endswith(extensions):
+                    continue
+                path = os.path.abspath(os.path.join(directory, filename))
+                if path in self._entries:
+                    continue
+                stat = os.stat(path)
+                self._entries[path] = {
+                    "class": artifact_class,
+                    "size": stat.st_size,
+                    "last_access": stat.st_mtime,
+                }
+            # Forget entries whose files were removed outside the store
+            for path in [p for p, e in self._entries.items() if e["class"] == artifact_class]:
+                if os.path.dirname(path) == os.path.abspath(directory) and not os.path.exists(path):
+                    del self._entries[path]
+            self._save()
+
+    def add(self, artifact_class, path):
+        """Record a newly written artifact and enforce its class budget."""
+        path = os.path.abspath(path)
+        if not os.path.exists(path):
+            return
+        with self._lock:
+            self._entries[path] = {
+                "class": artifact_class,
+                "size": os.path.getsize(path),
+                "last_access": time.time(),
+            }
+            self._evicted.discard(path)
+            self._save()
+        self.enforce(artifact_class)
+
+    def touch(self, path):
+        """Mark an artifact as just used."""
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return
+            entry["last_access"] = time.time()
+            self._dirty = True
+            if time.time() - self._last_save > self.SAVE_INTERVAL:
+                self._save()
+
+    def flush(self):
+        """Persist access times recorded by touch() that haven't been saved yet."""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def discard(self, path):
+        """Stop tracking an artifact that was deleted on purpose."""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._entries.pop(path, None)
+            self._evicted.discard(path)
+            self._save()
+
+    def was_evicted(self, path):
+        """Check whether a path was removed by budget enforcement."""
+        return os.path.abspath(path) in self._evicted
+
+    def usage(self, artifact_class):
+        """Return the total tracked size in bytes for an artifact class."""
+        with self._lock:
+            return sum(e["size"] for e in self._entries.values() if e["class"] == artifact_class)
+
+    def enforce(self, artifact_class):
+        """Evict least recently used artifacts until the class fits its budget."""
+        budget = config.artifact_budgets.get(artifact_class)
+        if budget is None:
+            return []
+        if artifact_class not in self.regenerable:
+            usage = self.usage(artifact_class)
+            if usage > budget:
+                print(f"{artifact_class} uses {usage} bytes, over its {budget} byte budget; "
+                      f"not evicting because these files can't be regenerated")
+            return []
+
+        evicted = []
+        with self._lock:
+            entries = sorted(
+                ((path, e) for path, e in self._entries.items() if e["class"] == artifact_class),
+                key=lambda item: item[1]["last_access"]
+            )
+            total = sum(e["size"] for _, e in entries)
+            for path, entry in entries:
+                if total <= budget:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Failed to evict {path}: {e}")
+                    continue
+                del self._entries[path]
+                self._evicted.add(path)
+                total -= entry["size"]
+                evicted.append(path)
+            if evicted or self._dirty:
+                self._save()
+
+        if evicted:
+            print(f"Evicted {len(evicted)} {artifact_class} artifact(s) to stay within {budget} bytes")
+        return evicted
+
+
+# Module-level instance that will be shared
+artifact_store = ArtifactStore(config.artifact_index_file, regenerable=("thumbnails",))
@@ -63,6 +63,39 @@ class ConfigManager:
     def db_file(self):
         return self._config_data.get("db_file")
 
+    @property
+    def artifact_budgets(self):
+        """Byte budget per artifact class; a missing or null budget means unlimited.
+
+        Only regenerable classes (thumbnails) are evicted; others are just reported.
+        """
+        return self._config_data.get("artifact_budgets", {})
+
+    @property
+    def artifact_index_file(self):
+        return self._config_data.get(
+            "artifact_index_file",
+            os.path.join(self.thumbnail_dir, ".artifact_index.json")
+        )
+
+    @property
+    def job_journal_file(self):
+        return self._config_data.get(
+            "job_journal_file",
+            # Kept in the thumbnail directory, which is volume-mounted in docker-compose
+            os.path.join(self.thumbnail_dir, ".pending_jobs.json")
+        )
+
+    @property
+    def shutdown_timeout(self):
+        """Seconds to let in-flight streams and jobs finish before shutting down."""
+        return self._config_data.get("shutdown_timeout", 30)
+
+    @property
+    def job_abort_timeout(self):
+        """Seconds to wait for aborted ingest jobs to clean up after the drain deadline."""
+        return self._config_data.get("job_abort_timeout", 10)
+
     def reload(self):
         self._load_config()
 
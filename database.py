@@ -1,27 +1,86 @@
 import json
 import os
+import fcntl
+import threading
+from contextlib import contextmanager
 
 from config import config
 
 
+# Incremented on every write so derived views (e.g. the cached index page) can tell they are stale
+_catalog_version = 0
+
+# Serialises catalog reads and read-modify-write cycles across threads and processes
+_catalog_thread_lock = threading.RLock()
+_catalog_lock_depth = 0
+
+@contextmanager
+def catalog_lock():
+    """Hold an exclusive lock on the catalog; re-entrant within a thread.
+
+    Uses a file lock next to the database so another server process (e.g.
+    during a socket handoff) can't interleave its writes with ours.
+    """
+    global _catalog_lock_depth
+    with _catalog_thread_lock:
+        if _catalog_lock_depth:
+            _catalog_lock_depth += 1
+            try:
+                yield
+            finally:
+                _catalog_lock_depth -= 1
+            return
+
+        with open(f"{config.db_file}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            _catalog_lock_depth = 1
+            try:
+                yield
+            finally:
+                _catalog_lock_depth = 0
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def get_catalog_version():
+    """Return a value that changes whenever the catalog is modified.
+
+    Includes the database file's mtime so writes by another process are seen too.
+    """
+    try:
+        mtime = os.stat(config.db_file).st_mtime_ns
+    except OSError:
+        mtime = None
+    return _catalog_version, mtime
+
+def mark_catalog_changed():
+    """Invalidate views derived from the catalog."""
+    global _catalog_version
+    _catalog_version += 1
+
 # Database functions
 def init_db():
     """Initialize the database if it doesn't exist."""
-    if not os.path.exists(config.db_file):
-        with open(config.db_file, 'w') as f:
-            json.dump({"videos": []}, f)
+    with catalog_lock():
+        if not os.path.exists(config.db_file):
+            with open(config.db_file, 'w') as f:
+                json.dump({"videos": [], "hash_index": {}}, f)
 
 def load_db():
     """Load the video database."""
-    if not os.path.exists(config.db_file):
-        init_db()
-    with open(config.db_file, 'r') as f:
-        return json.load(f)
+    with catalog_lock():
+        if not os.path.exists(config.db_file):
+            init_db()
+        with open(config.db_file, 'r') as f:
+            return json.load(f)
 
 def save_db(db):
-    """Save the database to disk."""
-    with open(config.db_file, 'w') as f:
-        json.dump(db, f, indent=2)
+    """Save the database to disk.
+
+    Written in place rather than renamed, since docker-compose bind-mounts the file itself.
+    """
+    with catalog_lock():
+        with open(config.db_file, 'w') as f:
+            json.dump(db, f, indent=2)
+    mark_catalog_changed()
 
 def get_video_by_id(video_id):
     """Get a video entry by its ID."""
@@ -31,31 +90,72 @@ def get_video_by_id(video_id):
             return video
     return None
 
+def get_video_by_hash(content_hash):
+    """Get a video entry by the content hash of its ingested file."""
+    db = load_db()
+    video_id = db.get("hash_index", {}).get(content_hash)
+    if video_id is None:
+        return None
+    for video in db["videos"]:
+        if video["id"] == video_id:
+            return video
+    return None
+
 def add_video_to_db(video_data):
     """Add a new video entry to the database."""
-    db = load_db()
-    db["videos"].append(video_data)
-    save_db(db)
-    return video_data
+    with catalog_lock():
+        db = load_db()
+        db["videos"].append(video_data)
+        if video_data.get("content_hash"):
+            db.setdefault("hash_index", {})[video_data["content_hash"]] = video_data["id"]
+        save_db(db)
+        return video_data
 
 def update_video_in_db(video_id, updated_data):
     """Update an existing video entry in the database."""
-    db = load_db()
-    for i, video in enumerate(db["videos"]):
-        if video["id"] == video_id:
-            # Update fields
+    with catalog_lock():
+        db = load_db()
+        for i, video in enumerate(db["videos"]):
+            if video["id"] == video_id:
+                # Update fields
+                for key, value in updated_data.items():
+                    db["videos"][i][key] = value
+                if updated_data.get("content_hash"):
+                    db.setdefault("hash_index", {})[updated_data["content_hash"]] = video_id
+                save_db(db)
+                return db["videos"][i]
+        return None
+
+def update_videos_in_db(updates):
+    """Apply {video_id: fields} updates to many entries with one load and save.
+
+    The database is re-loaded here, so only the given fields are merged into
+    the current entries and concurrent writes to other fields are kept.
+    """
+    if not updates:
+        return
+    with catalog_lock():
+        db = load_db()
+        for video in db["videos"]:
+            updated_data = updates.get(video["id"])
+            if not updated_data:
+                continue
             for key, value in updated_data.items():
-                db["videos"][i][key] = value
-            save_db(db)
-            return db["videos"][i]
-    return None
+                video[key] = value
+            if updated_data.get("content_hash"):
+                db.setdefault("hash_index", {})[updated_data["content_hash"]] = video["id"]
+        save_db(db)
 
 def delete_video_from_db(video_id):
     """Delete a video entry from the database."""
-    db = load_db()
-    for i, video in enumerate(db["videos"]):
-        if video["id"] == video_id:
-            del db["videos"][i]
-            save_db(db)
-            return True
-    return False
\ No newline at end of file
+    with catalog_lock():
+        db = load_db()
+        for i, video in enumerate(db["videos"]):
+            if video["id"] == video_id:
+                del db["videos"][i]
+                hash_index = db.get("hash_index", {})
+                if hash_index.get(video.get("content_hash")) == video_id:
+                    del hash_index[video["content_hash"]]
+                save_db(db)
+                return True
+        return False
\ No newline at end of file
@@ -0,0 +1,220 @@
+# lifecycle.py
+import json
+import os
+import time
+import fcntl
+import socket
+import threading
+import datetime
+from contextlib import contextmanager
+
+import uvicorn
+
+from config import config
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when the server is shutting down and the job must stop."""
+
+
+def process_is_alive(pid):
+    """Check whether another process with this PID is running.
+
+    Our own PID counts as not alive: callers use this at startup to spot
+    leftovers from a previous run, which in a container often had the same PID.
+    """
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobTracker:
+    """Track in-flight ingest jobs so shutdown can drain, abort and resume them.
+
+    Each job is journaled to disk with the owning process's PID and a
+    heartbeat, and removed when it finishes (successfully or not). Owners
+    refresh their heartbeats while running; an entry whose lease has expired,
+    or that was released by a shutdown abort, is an orphan and is adopted by
+    whichever process is running. The journal is guarded by a file lock so
+    an old and a new process can share it during a handoff.
+    """
+
+    LEASE_SECONDS = 30  # A job whose heartbeat is older than this has no live owner
+    HEARTBEAT_INTERVAL = 10
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.draining = threading.Event()
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._stop_maintenance = threading.Event()
+
+    @contextmanager
+    def _journal_lock(self):
+        """Hold both the in-process and the cross-process journal locks."""
+        with self._lock:
+            with open(f"{self.journal_file}.lock", 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_journal(self):
+        try:
+            with open(self.journal_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_journal(self, journal):
+        tmp_path = f"{self.journal_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(journal, f, indent=2)
+        os.replace(tmp_path, self.journal_file)
+
+    def start(self, task_id, url):
+        """Register a job, take ownership of its journal entry and return its cancel event."""
+        cancel_event = threading.Event()
+        with self._journal_lock():
+            self._jobs[task_id] = {"cancel": cancel_event, "done": threading.Event()}
+            journal = self._load_journal()
+            entry = journal.setdefault(task_id, {"url": url, "started": datetime.datetime.now().isoformat()})
+            entry["owner"] = os.getpid()
+            entry["heartbeat"] = time.time()
+            self._save_journal(journal)
+        return cancel_event
+
+    def finish(self, task_id, keep_journal=False):
+        """Mark a job as done.
+
+        Aborted jobs keep their journal entry with the lease released, so
+        another running process (or the next start) resumes them right away.
+        """
+        with self._journal_lock():
+            job = self._jobs.pop(task_id, None)
+            journal = self._load_journal()
+            if keep_journal:
+                if task_id in journal:
+                    journal[task_id]["heartbeat"] = 0
+                    self._save_journal(journal)
+            elif journal.pop(task_id, None) is not None:
+                self._save_journal(journal)
+        if job:
+            job["done"].set()
+
+    def heartbeat(self):
+        """Renew the lease on every job this process is running."""
+        with self._journal_lock():
+            if not self._jobs:
+                return
+            journal = self._load_journal()
+            now = time.time()
+            for task_id in self._jobs:
+                if task_id in journal:
+                    journal[task_id]["owner"] = os.getpid()
+                    journal[task_id]["heartbeat"] = now
+            self._save_journal(journal)
+
+    def claim_orphans(self):
+        """Take over journaled jobs whose owner has stopped renewing its lease."""
+        if self.draining.is_set():
+            return {}
+        claimed = {}
+        with self._journal_lock():
+            journal = self._load_journal()
+            now = time.time()
+            for task_id, entry in journal.items():
+                if task_id in self._jobs or now - entry.get("heartbeat", 0) < self.LEASE_SECONDS:
+                    continue
+                entry["owner"] = os.getpid()
+                entry["heartbeat"] = now
+                claimed[task_id] = entry
+            if claimed:
+                self._save_journal(journal)
+        return claimed
+
+    def start_maintenance(self, on_orphans):
+        """Renew leases and adopt orphaned jobs on a background thread until stopped."""
+        def run():
+            while True:
+                try:
+                    self.heartbeat()
+                    orphans = self.claim_orphans()
+                    if orphans:
+                        on_orphans(orphans)
+                except Exception as e:
+                    print(f"Job journal maintenance failed: {e}")
+                if self._stop_maintenance.wait(self.HEARTBEAT_INTERVAL):
+                    return
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop_maintenance(self):
+        self._stop_maintenance.set()
+
+    def check(self, task_id):
+        """Raise JobCancelled if the job has been asked to stop."""
+        job = self._jobs.get(task_id)
+        if job and job["cancel"].is_set():
+            raise JobCancelled(f"Task {task_id} aborted for shutdown")
+
+    def begin_drain(self):
+        """Stop accepting new jobs."""
+        self.draining.set()
+
+    def abort_all(self, timeout):
+        """Cancel running jobs and wait up to `timeout` seconds for them to clean up."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job["cancel"].set()
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+        for job in jobs:
+            remaining = (deadline - datetime.datetime.now()).total_seconds()
+            job["done"].wait(max(0, remaining))
+
+
+class DrainingServer(uvicorn.Server):
+    """Uvicorn server that flags the app as draining as soon as a stop signal arrives.
+
+    Uvicorn then stops accepting connections and lets in-flight requests
+    finish for up to `timeout_graceful_shutdown` seconds.
+    """
+
+    def handle_exit(self, sig, frame):
+        job_tracker.begin_drain()
+        super().handle_exit(sig, frame)
+
+
+def get_listen_socket(host, port):
+    """Return the listening socket, inheriting one from a supervisor if provided.
+
+    Supports systemd-style socket activation (LISTEN_FDS/LISTEN_PID). Otherwise
+    binds with SO_REUSEPORT so a new process can start listening on the same
+    port before the old one stops, avoiding refused connections during restarts.
+    """
+    if os.environ.get("LISTEN_PID") == str(os.getpid()) and int(os.environ.get("LISTEN_FDS", 0)) > 0:
+        sock = socket.socket(fileno=3)  # SD_LISTEN_FDS_START
+        sock.setblocking(False)
+        return sock
+
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+# Module-level instance that will be shared
+job_tracker = JobTracker(config.job_journal_file)
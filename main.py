@@ -1,26 +1,61 @@
 from pathlib import Path
 from fastapi import FastAPI, HTTPException, Request, Header, Query, BackgroundTasks
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 import os
+import gzip
+import threading
+import json
+import asyncio
 import tempfile
 import uuid
+import hashlib
 import shutil
 import ffmpeg
 import time
 import requests
 import datetime
+from email.utils import parsedate_to_datetime
 from pydantic import BaseModel
 from typing import List
+from contextlib import asynccontextmanager
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; gzip is always available
+    brotli = None
 
 from middleware import add_cors_middleware, whitelist_middleware
+from progress import task_events
+from artifacts import artifact_store
+from lifecycle import DrainingServer, JobCancelled, get_listen_socket, job_tracker
 from utils import *
 from database import *
 from config import config
 
 
-app = FastAPI()
+# Application Events
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run startup tasks, then drain and abort ingest jobs on shutdown."""
+    init_db()  # Initialize the database if it doesn't exist
+    remove_partial_outputs()  # Clean up after transcodes killed by a previous shutdown
+    migrate_existing_videos()  # Migrate existing videos to the database
+    process_existing_webm_files()
+    scan_artifacts()  # Track existing thumbnails/archives and enforce disk budgets
+    create_thumbnails_on_startup()
+    job_tracker.start_maintenance(resume_jobs)  # Renew job leases and adopt orphaned jobs
+
+    yield
+
+    # Uvicorn has already let in-flight requests finish up to the graceful
+    # shutdown deadline; stop whatever ingest jobs are still running.
+    job_tracker.begin_drain()
+    job_tracker.stop_maintenance()
+    await asyncio.to_thread(job_tracker.abort_all, config.job_abort_timeout)
+    artifact_store.flush()  # Persist access times recorded since the last periodic save
+
+app = FastAPI(lifespan=lifespan)
 
 os.makedirs(config.thumbnail_dir, exist_ok=True)
 
@@ -28,36 +63,99 @@ templates = Jinja2Templates(directory="templates")
 add_cors_middleware(app)
 app.middleware("http")(whitelist_middleware)
 
-# Application Events
-@app.on_event("startup")
-async def startup_tasks():
-    """Run startup tasks including database initialization and thumbnail generation."""
-    init_db()  # Initialize the database if it doesn't exist
-    migrate_existing_videos()  # Migrate existing videos to the database
-    process_existing_webm_files()
-    create_thumbnails_on_startup()
+# Rendered index pages keyed by (video_dir, sort), each stored with precompressed variants
+index_cache = {}
+
+def render_index_page(sort_preference):
+    """Return the cached index page for the current library and sort, rendering it if stale."""
+    key = (config.video_dir, sort_preference)
+    version = get_catalog_version()
+    cached = index_cache.get(key)
+    if cached and cached["version"] == version:
+        return cached
 
-# Routes
-@app.get("/")
-async def index(request: Request):
-    # Get the sort preference, default to "newest"
-    sort_preference = getattr(app.state, "sort_preference", "newest")
-    
     # Get sorted video files
     video_files = get_video_files(sort_by=sort_preference)
     
     # Get timestamp for cache busting
     timestamp = int(time.time())
     
-    return templates.TemplateResponse(
-        "index.html", 
-        {
-            "request": request, 
-            "video_files": video_files,
-            "timestamp": timestamp,
-            "sibling_folders": get_sibling_folders(),
-            "current_sort": sort_preference  # Pass current sort to template
-        }
+    html = templates.get_template("index.html").render(
+        video_files=video_files,
+        timestamp=timestamp,
+        sibling_folders=get_sibling_folders(),
+        current_sort=sort_preference  # Pass current sort to template
+    ).encode("utf-8")
+
+    bodies = {"identity": html, "gzip": gzip.compress(html, compresslevel=9)}
+    if brotli is not None:
+        bodies["br"] = brotli.compress(html, quality=5)
+
+    # Each encoding is a different representation, so each gets its own validator
+    digest = hashlib.sha1(html).hexdigest()
+    etags = {
+        encoding: f'"{digest}"' if encoding == "identity" else f'"{digest}-{encoding}"'
+        for encoding in bodies
+    }
+
+    cached = {
+        "version": version,
+        "etags": etags,
+        "bodies": bodies,
+    }
+    index_cache[key] = cached
+    return cached
+
+def choose_encoding(accept_encoding, available):
+    """Pick the best precompressed variant the client accepts."""
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        coding, *params = [piece.strip() for piece in part.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            accepted.add(coding.lower())
+    for encoding in ("br", "gzip"):
+        if encoding in available and encoding in accepted:
+            return encoding
+    return "identity"
+
+def etag_matches(if_none_match, etag):
+    """Check an If-None-Match header against an ETag, ignoring weak prefixes."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+# Routes
+@app.get("/")
+async def index(request: Request):
+    # Get the sort preference, default to "newest"
+    sort_preference = getattr(app.state, "sort_preference", "newest")
+    # Rendering and compressing after a catalog change would otherwise block the event loop
+    page = await asyncio.to_thread(render_index_page, sort_preference)
+
+    encoding = choose_encoding(request.headers.get("accept-encoding"), page["bodies"])
+    headers = {
+        "ETag": page["etags"][encoding],
+        "Cache-Control": "no-cache",  # Always revalidate, served from cache via 304
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request.headers.get("if-none-match"), page["etags"][encoding]):
+        return Response(status_code=304, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(
+        content=page["bodies"][encoding],
+        media_type="text/html; charset=utf-8",
+        headers=headers
     )
 
 
@@ -93,8 +191,13 @@ async def stream_video(video_id: str, range: str = Header(None)):
 
     # Calculate content length for the response
     content_length = end - start + 1
-    ext = os.path.splitext(video["path"])[1].lower()
-    mime_type = "video/mp4" if ext == ".mp4" else "video/webm"
+    media = video.get("media") or {}
+    container = media.get("container") or ""
+    if container:
+        mime_type = "video/webm" if "webm" in container else "video/mp4"
+    else:
+        ext = os.path.splitext(video["path"])[1].lower()
+        mime_type = "video/mp4" if ext == ".mp4" else "video/webm"
     headers = {
         "Content-Range": f"bytes {start}-{end}/{file_size}",
         "Accept-Ranges": "bytes",
@@ -127,7 +230,11 @@ class ChangeDirectoryRequest(BaseModel):
     folder: str
 
 @app.post("/api/change-directory")
-async def change_directory(request: ChangeDirectoryRequest):
+def change_directory(request: ChangeDirectoryRequest):
+    # Plain def so the scan, hashing and transcodes run in the threadpool, not the event loop
+    if job_tracker.draining.is_set():
+        raise HTTPException(status_code=503, detail="Server is shutting down")
+
     new_folder = request.folder
     
     # Get the parent directory
@@ -146,6 +253,7 @@ async def change_directory(request: ChangeDirectoryRequest):
     init_db()
     migrate_existing_videos()
     process_existing_webm_files()
+    scan_artifacts()
     create_thumbnails_on_startup()
     
     return {"message": f"Directory changed to {new_folder}"}
@@ -154,6 +262,11 @@ async def change_directory(request: ChangeDirectoryRequest):
 
 task_status = {}
 
+def update_task(task_id, **fields):
+    """Update a task's status and push the new snapshot to event stream subscribers."""
+    task_status[task_id].update(fields)
+    task_events.publish(task_id, task_status[task_id])
+
 class DownloadRequest(BaseModel):
     url: str
 
@@ -162,62 +275,91 @@ def download_video(download_request: DownloadRequest, background_tasks: Backgrou
     url = download_request.url
     if not url or not url.lower().endswith(('.webm', '.mp4')):
         raise HTTPException(status_code=400, detail="Invalid URL or unsupported file format.")
+    if job_tracker.draining.is_set():
+        raise HTTPException(status_code=503, detail="Server is shutting down")
     
     task_id = str(uuid.uuid4())
     task_status[task_id] = {"status": "in_progress", "progress": 0, "error": None}
+    task_events.publish(task_id, task_status[task_id])
 
     background_tasks.add_task(process_download_task, task_id, url)
 
     return {"task_id": task_id}
 
+def resume_jobs(jobs):
+    """Restart journaled downloads whose previous owner aborted them or went away."""
+    for task_id, job in jobs.items():
+        print(f"Resuming interrupted download {job['url']}")
+        task_status[task_id] = {"status": "in_progress", "progress": 0, "error": None}
+        threading.Thread(target=process_download_task, args=(task_id, job["url"]), daemon=True).start()
+
 def process_download_task(task_id, url):
+    cancel_event = job_tracker.start(task_id, url)
+    keep_journal = False
     try:
         is_webm = url.lower().endswith('.webm')
         original_filename = url.split("/")[-1]
 
         # Download
-        task_status[task_id]["status"] = "downloading"
-        task_status[task_id]["progress"] = 0
+        update_task(task_id, status="downloading", progress=0)
         response = requests.get(url, stream=True)
         response.raise_for_status()
 
         total_size = int(response.headers.get('content-length', 0))
+        update_task(task_id, downloaded_bytes=0, total_bytes=total_size or None)
         downloaded_size = 0
+        content_digest = hashlib.sha256()
         with tempfile.TemporaryDirectory() as tmp_dir:
             tmp_webm_path = os.path.join(tmp_dir, original_filename)
             with open(tmp_webm_path, 'wb') as f:
                 for chunk in response.iter_content(chunk_size=1024*1024):
+                    job_tracker.check(task_id)
                     if chunk:
                         f.write(chunk)
+                        content_digest.update(chunk)
                         downloaded_size += len(chunk)
-                        task_status[task_id]["progress"] = int((downloaded_size / total_size) * 30)
+                        update_task(
+                            task_id,
+                            downloaded_bytes=downloaded_size,
+                            progress=int((downloaded_size / total_size) * 30) if total_size else 0
+                        )
+            content_hash = content_digest.hexdigest()
+
+            # Link to the existing entry instead of storing and transcoding again
+            duplicate = find_duplicate_video(content_hash)
+            if duplicate:
+                link_duplicate(duplicate, url)
+                update_task(task_id, duplicate_of=duplicate["id"], progress=100, status="completed")
+                return
 
             # Generate a unique ID for the video
             video_id = str(uuid.uuid4())
             
             if is_webm:
                 # Convert to MP4
-                task_status[task_id]["status"] = "converting"
-                task_status[task_id]["progress"] = 30
+                update_task(task_id, status="converting", progress=30)
                 base_name = Path(original_filename).stem
                 mp4_filename = f"{video_id}.mp4"  # Use the video ID as filename
                 mp4_path = os.path.join(config.video_dir, mp4_filename)
-                (
-                    ffmpeg
-                    .input(tmp_webm_path)
-                    .output(mp4_path, vcodec='libx264', acodec='aac')
-                    .run(capture_stdout=True, capture_stderr=True)
+
+                def report_transcode(progress):
+                    # Map the transcode's own percentage onto the 30-60 band
+                    percent = progress["percent"] or 0
+                    update_task(
+                        task_id,
+                        progress=30 + int(percent * 0.3),
+                        transcode_percent=progress["percent"],
+                        fps=progress["fps"],
+                        speed=progress["speed"]
+                    )
+
+                transcode_to_mp4(
+                    tmp_webm_path, mp4_path, on_progress=report_transcode, cancel_event=cancel_event
                 )
-                task_status[task_id]["progress"] = 60
+                update_task(task_id, progress=60)
 
                 # Move WebM to original directory
-                original_webm_dir = get_original_webm_dir()
-                os.makedirs(original_webm_dir, exist_ok=True)
-                original_webm_path = os.path.join(
-                    original_webm_dir, 
-                    f"{video_id}_original.webm"
-                )
-                shutil.move(tmp_webm_path, original_webm_path)
+                archive_original_webm(tmp_webm_path, f"{video_id}_original.webm")
                 
                 # Set path for database
                 saved_path = mp4_filename
@@ -225,18 +367,18 @@ def process_download_task(task_id, url):
                 # Direct MP4 download
                 filename = f"{video_id}.mp4"  # Use the video ID as filename
                 save_path = os.path.join(config.video_dir, filename)
-                shutil.move(tmp_webm_path, save_path)
+                move_into_place(tmp_webm_path, save_path)
                 mp4_path = save_path
                 saved_path = filename
-                task_status[task_id]["progress"] = 60
+                update_task(task_id, progress=60)
 
             # Generate thumbnail
-            task_status[task_id]["status"] = "generating_thumbnail"
-            task_status[task_id]["progress"] = 80
-            has_audio = has_audio_stream(mp4_path)
+            update_task(task_id, status="generating_thumbnail", progress=80)
+            media = probe_media(mp4_path)
+            has_audio = media["has_audio"] if media else False
             thumbnail_path_base = os.path.join(config.thumbnail_dir, video_id)
             generate_thumbnail(mp4_path, thumbnail_path_base, has_audio)
-            task_status[task_id]["progress"] = 90
+            update_task(task_id, progress=90)
             
             # Add to database
             creation_time = datetime.datetime.now().isoformat()
@@ -249,14 +391,21 @@ def process_download_task(task_id, url):
                 "creation_date": creation_time,
                 "description": "",
                 "tags": [],
-                "has_audio": has_audio
+                "has_audio": has_audio,
+                "media": media,
+                "content_hash": content_hash
             })
-            task_status[task_id]["progress"] = 100
+            update_task(task_id, progress=100)
 
-        task_status[task_id]["status"] = "completed"
+        update_task(task_id, status="completed")
+    except JobCancelled as e:
+        # Leave the job in the journal so it is resumed after the restart
+        keep_journal = True
+        update_task(task_id, status="aborted", error=str(e))
     except Exception as e:
-        task_status[task_id]["status"] = "failed"
-        task_status[task_id]["error"] = str(e)
+        update_task(task_id, status="failed", error=str(e))
+    finally:
+        job_tracker.finish(task_id, keep_journal=keep_journal)
 
 @app.get("/api/task-status/{task_id}")
 def get_task_status(task_id: str):
@@ -264,6 +413,43 @@ def get_task_status(task_id: str):
         raise HTTPException(status_code=404, detail="Task not found")
     return task_status[task_id]
 
+@app.get("/api/task-events")
+async def stream_task_events(request: Request):
+    """Push status updates for all download tasks as Server-Sent Events."""
+    queue = task_events.subscribe()
+
+    async def event_stream():
+        try:
+            # Start with a snapshot of every known task
+            for task_id, status in list(task_status.items()):
+                yield f"data: {json.dumps(dict(status, task_id=task_id))}\n\n"
+
+            idle_seconds = 0
+            while not await request.is_disconnected():
+                # End the stream when shutting down so it doesn't hold up the drain;
+                # the browser's EventSource reconnects to the next process on its own
+                if job_tracker.draining.is_set():
+                    yield "retry: 2000\n\n"
+                    return
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=1)
+                except asyncio.TimeoutError:
+                    idle_seconds += 1
+                    if idle_seconds >= 15:
+                        idle_seconds = 0
+                        yield ": keep-alive\n\n"
+                    continue
+                idle_seconds = 0
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            task_events.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/play/{video_id}")
 async def play_video(video_id: str, request: Request):
     """Render an HTML page to play the video."""
@@ -320,6 +506,7 @@ async def delete_video(video_id: str):
     thumbnail_path = os.path.join(config.thumbnail_dir, f"{video_id}.jpg")
     if os.path.exists(thumbnail_path):
         os.remove(thumbnail_path)
+    artifact_store.discard(thumbnail_path)
     
     # Remove from database
     if delete_video_from_db(video_id):
@@ -341,7 +528,8 @@ async def generate_custom_thumbnail(
     if not os.path.isfile(video_path):
         raise HTTPException(status_code=404, detail=f"Video file not found at '{video_path}'.")
     
-    has_audio = video.get("has_audio", has_audio_stream(video_path))
+    media = get_media_info(video, video_path)
+    has_audio = media["has_audio"] if media else video.get("has_audio", False)
     thumbnail_base = os.path.join(config.thumbnail_dir, video_id)
     
     # Delete existing thumbnails
@@ -351,9 +539,13 @@ async def generate_custom_thumbnail(
     ]
     for thumbnail in existing_thumbnails:
         os.remove(os.path.join(config.thumbnail_dir, thumbnail))
+        artifact_store.discard(os.path.join(config.thumbnail_dir, thumbnail))
     
     try:
         generate_thumbnail(video_path, thumbnail_base, has_audio, time=time)
+        # Remember the time so an evicted thumbnail is regenerated at the same frame.
+        # This also re-renders the cached index so the new thumbnail is cache-busted.
+        update_video_in_db(video_id, {"thumbnail_time": time})
         return {"detail": "Thumbnail successfully updated."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate thumbnail: {str(e)}")
@@ -369,9 +561,53 @@ async def sort_videos(sort_data: dict):
     
     return {"status": "success"}
 
-# Serve the thumbnails directory as static files
-app.mount("/thumbnails", StaticFiles(directory=config.thumbnail_dir), name="thumbnails")
+def thumbnail_response(request, thumbnail_path):
+    """Serve a thumbnail file, answering conditional GETs with 304 like StaticFiles does."""
+    response = FileResponse(thumbnail_path, media_type="image/jpeg", stat_result=os.stat(thumbnail_path))
+    validators = {
+        key: response.headers[key] for key in ("etag", "last-modified") if key in response.headers
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        if etag_matches(if_none_match, validators.get("etag")):
+            return Response(status_code=304, headers=validators)
+        return response
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and "last-modified" in validators:
+        try:
+            if parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(validators["last-modified"]):
+                return Response(status_code=304, headers=validators)
+        except (TypeError, ValueError):
+            pass
+    return response
+
+@app.get("/thumbnails/{filename}")
+def serve_thumbnail(filename: str, request: Request):
+    """Serve a thumbnail, regenerating it on demand if it was evicted."""
+    video_id, ext = os.path.splitext(filename)
+    if ext.lower() != ".jpg" or video_id.startswith("."):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+
+    # Serve existing thumbnails without touching the catalog
+    thumbnail_path = os.path.join(config.thumbnail_dir, f"{video_id}.jpg")
+    if os.path.exists(thumbnail_path):
+        artifact_store.touch(thumbnail_path)
+        return thumbnail_response(request, thumbnail_path)
+    if thumbnail_recently_failed(thumbnail_path):
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+
+    video = get_video_by_id(video_id)
+    if not video:
+        raise HTTPException(status_code=404, detail=f"Video with ID '{video_id}' not found.")
+
+    thumbnail_path = get_thumbnail(video)
+    if not thumbnail_path:
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+    return thumbnail_response(request, thumbnail_path)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=6969)
+    server = DrainingServer(uvicorn.Config(app, timeout_graceful_shutdown=config.shutdown_timeout))
+    server.run(sockets=[get_listen_socket("0.0.0.0", 6969)])
@@ -0,0 +1,85 @@
+# progress.py
+import asyncio
+import threading
+
+
+class TaskEventBroker:
+    """Fan out task status updates to every connected event stream.
+
+    Download tasks run in worker threads, so updates are handed to each
+    subscriber's event loop with call_soon_threadsafe.
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """Register a new subscriber and return its queue."""
+        queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers.add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, queue):
+        """Remove a subscriber previously returned by subscribe()."""
+        with self._lock:
+            self._subscribers = {s for s in self._subscribers if s[1] is not queue}
+
+    def publish(self, task_id, status):
+        """Send a snapshot of a task's status to all subscribers."""
+        event = dict(status, task_id=task_id)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:
+                # The subscriber's loop has already closed
+                self.unsubscribe(queue)
+
+
+def parse_ffmpeg_progress(lines, duration=None):
+    """Yield progress dicts from ffmpeg `-progress` key=value output.
+
+    Each block ends with a `progress=continue|end` line. When the input
+    duration is known the position is converted to a percentage.
+    """
+    block = {}
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode(errors="ignore")
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            continue
+        block[key] = value
+        if key != "progress":
+            continue
+
+        out_time_us = block.get("out_time_us") or block.get("out_time_ms")
+        try:
+            position = int(out_time_us) / 1_000_000
+        except (TypeError, ValueError):
+            position = None
+        try:
+            fps = float(block.get("fps", 0))
+        except ValueError:
+            fps = None
+
+        percent = None
+        if position is not None and duration:
+            percent = max(0.0, min(100.0, position / duration * 100))
+        if value == "end":
+            percent = 100.0
+
+        yield {
+            "position": position,
+            "fps": fps,
+            "speed": block.get("speed"),
+            "percent": percent,
+            "done": value == "end",
+        }
+        block = {}
+
+
+task_events = TaskEventBroker()
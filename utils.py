@@ -2,27 +2,109 @@
 import os
 import subprocess
 import shutil
+import tempfile
 from pathlib import Path
 import ffmpeg
 import uuid
+import hashlib
 import datetime
 
-from database import init_db, load_db, save_db, add_video_to_db
+from progress import parse_ffmpeg_progress
+from artifacts import artifact_store
+from lifecycle import JobCancelled, process_is_alive
+from database import (
+    init_db, load_db, add_video_to_db, update_video_in_db, update_videos_in_db, get_video_by_hash
+)
 from config import config
 
 
-def has_audio_stream(video_path: str) -> bool:
-    """Check if a video file contains an audio stream using FFmpeg."""
+def _file_signature(video_path):
+    """Return the (size, mtime) pair used to invalidate cached media info."""
+    stat = os.stat(video_path)
+    return stat.st_size, stat.st_mtime
+
+def probe_media(video_path):
+    """Probe a video file once and return its container and stream metadata."""
+    try:
+        probe = ffmpeg.probe(video_path)
+    except ffmpeg.Error as e:
+        print(f"Probe failed for {video_path}: {e.stderr.decode(errors='ignore')}")
+        return None
+
+    streams = probe.get("streams", [])
+    fmt = probe.get("format", {})
+    video_stream = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio_stream = next((s for s in streams if s.get("codec_type") == "audio"), None)
+
+    def _number(value, cast):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+
+    size, mtime = _file_signature(video_path)
+    return {
+        "size": size,
+        "mtime": mtime,
+        "duration": _number(fmt.get("duration"), float),
+        "width": video_stream.get("width") if video_stream else None,
+        "height": video_stream.get("height") if video_stream else None,
+        "video_codec": video_stream.get("codec_name") if video_stream else None,
+        "audio_codec": audio_stream.get("codec_name") if audio_stream else None,
+        "bitrate": _number(fmt.get("bit_rate"), int),
+        "container": fmt.get("format_name"),
+        "has_audio": audio_stream is not None,
+    }
+
+def is_media_cache_valid(video, video_path):
+    """Check whether a video's cached media info still matches the file on disk."""
+    media = video.get("media")
+    if not media:
+        return False
     try:
-        probe = ffmpeg.probe(video_path, select_streams='a')
-        return bool(probe['streams'])
-    except ffmpeg.Error:
+        size, mtime = _file_signature(video_path)
+    except OSError:
         return False
+    return media.get("size") == size and media.get("mtime") == mtime
+
+def get_media_info(video, video_path=None, persist=True):
+    """Return cached media info for a video entry, re-probing only if the file changed.
+
+    With `persist=False` only the passed-in entry is updated, so callers that
+    already hold the loaded database can save it once after a batch.
+    """
+    if video_path is None:
+        video_path = os.path.join(config.video_dir, video["path"])
+    if is_media_cache_valid(video, video_path):
+        return video["media"]
+
+    media = probe_media(video_path)
+    if media is None:
+        return None
+    video["media"] = media
+    video["has_audio"] = media["has_audio"]
+    if persist:
+        update_video_in_db(video["id"], {"media": media, "has_audio": media["has_audio"]})
+    return media
+
+# Thumbnail paths whose generation failed, mapped to the time of the failure
+THUMBNAIL_RETRY_INTERVAL = 3600
+_thumbnail_failures = {}
+
+def thumbnail_recently_failed(thumbnail_path):
+    """Check whether generating this thumbnail failed within the retry interval."""
+    failed_at = _thumbnail_failures.get(thumbnail_path)
+    return failed_at is not None and datetime.datetime.now().timestamp() - failed_at < THUMBNAIL_RETRY_INTERVAL
 
 def generate_thumbnail(video_path, thumbnail_path_base, has_audio, time="00:00:01"):
-    """Generate a thumbnail for a video at the specified time."""
+    """Generate a thumbnail for a video at the specified time.
+
+    The frame is written to a unique temp name and renamed into place, so
+    concurrent requests never serve a half-written JPEG.
+    """
     # Use simple naming scheme: videoId.jpg
     thumbnail_path = f"{thumbnail_path_base}.jpg"
+    partial_path = get_partial_path(thumbnail_path, unique=True)
     
     # Optimized CPU-only FFmpeg command
     ffmpeg_command = [
@@ -34,9 +116,11 @@ def generate_thumbnail(video_path, thumbnail_path_base, has_audio, time="00:00:0
         "-qscale:v", "4",          # Faster JPEG encoding (2-31, lower=faster)
         "-compression_level", "1", # Fastest compression
         "-threads", "2",           # Optimal for small operations
+        "-f", "image2",            # Temp name has no .jpg extension to infer from
+        "-update", "1",            # Single image, not a numbered sequence
         "-y",                      # Overwrite existing files
         "-loglevel", "error",      # Suppress non-critical output
-        thumbnail_path
+        partial_path
     ]
     
     try:
@@ -48,12 +132,154 @@ def generate_thumbnail(video_path, thumbnail_path_base, has_audio, time="00:00:0
             timeout=2,
             check=True
         )
-    except (subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
+        os.replace(partial_path, thumbnail_path)
+    except (subprocess.TimeoutExpired, subprocess.CalledProcessError, OSError) as e:
         print(f"Thumbnail generation failed: {str(e)}")
+        _thumbnail_failures[thumbnail_path] = datetime.datetime.now().timestamp()
         return None
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
     
+    _thumbnail_failures.pop(thumbnail_path, None)
+    artifact_store.add("thumbnails", thumbnail_path)
     return thumbnail_path
 
+def get_thumbnail(video, time=None):
+    """Return the path to a video's thumbnail, regenerating it if it was evicted.
+
+    Returns None without spawning ffmpeg if regeneration failed recently.
+    """
+    thumbnail_base = os.path.join(config.thumbnail_dir, video["id"])
+    thumbnail_path = f"{thumbnail_base}.jpg"
+    if os.path.exists(thumbnail_path):
+        artifact_store.touch(thumbnail_path)
+        return thumbnail_path
+    if thumbnail_recently_failed(thumbnail_path):
+        return None
+
+    video_path = os.path.join(config.video_dir, video["path"])
+    if not os.path.isfile(video_path):
+        return None
+    media = get_media_info(video, video_path)
+    has_audio = media["has_audio"] if media else video.get("has_audio", False)
+    return generate_thumbnail(
+        video_path, thumbnail_base, has_audio, time=time or video.get("thumbnail_time", "00:00:01")
+    )
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Compute the SHA-256 content hash of a file, reading it in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def find_duplicate_video(content_hash):
+    """Return the existing entry with this content hash, if its file is still present."""
+    video = get_video_by_hash(content_hash)
+    if video and os.path.exists(os.path.join(config.video_dir, video["path"])):
+        return video
+    return None
+
+def link_duplicate(video, source):
+    """Record a duplicate source (filename or URL) against an existing entry."""
+    sources = video.get("duplicate_sources", [])
+    if source not in sources:
+        sources = sources + [source]
+        update_video_in_db(video["id"], {"duplicate_sources": sources})
+    return video
+
+def get_partial_path(path, unique=False):
+    """Return the hidden temp name a file is written under before being renamed into place.
+
+    The name starts with the writer's PID so cleanup can tell which partial
+    files still belong to a running process. `unique` adds a random token for
+    writers that may run concurrently on the same path.
+    """
+    directory, filename = os.path.split(path)
+    token = f"{uuid.uuid4().hex}." if unique else ""
+    return os.path.join(directory, f".{os.getpid()}.{token}{filename}.part")
+
+def move_into_place(source_path, destination_path):
+    """Move a file to its final name atomically, even across filesystems.
+
+    The file is first copied next to the destination under a temp name and
+    then renamed, so scans never see a half-written video.
+    """
+    partial_path = get_partial_path(destination_path)
+    try:
+        shutil.move(source_path, partial_path)
+        os.replace(partial_path, destination_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+def remove_partial_outputs():
+    """Delete temp files left behind by transcodes or moves that were interrupted.
+
+    Partial files whose writer is still running (e.g. an old process that is
+    draining during a handoff) are left alone.
+    """
+    for directory in (config.video_dir, get_original_webm_dir(), config.thumbnail_dir):
+        if not os.path.isdir(directory):
+            continue
+        for filename in os.listdir(directory):
+            if not (filename.startswith(".") and filename.endswith(".part")):
+                continue
+            writer_pid = filename[1:].split(".", 1)[0]
+            if writer_pid.isdigit() and process_is_alive(int(writer_pid)):
+                continue
+            print(f"Removing interrupted output {filename}")
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+
+def transcode_to_mp4(source_path, mp4_path, on_progress=None, cancel_event=None):
+    """Transcode a video to H.264/AAC MP4, reporting ffmpeg progress as it runs.
+
+    Output is written to a temp name and renamed into place only on success.
+    `on_progress` is called with dicts from parse_ffmpeg_progress. Raises
+    ffmpeg.Error if the transcode fails, like ffmpeg-python's run(), or
+    JobCancelled if `cancel_event` is set while ffmpeg is running.
+    """
+    try:
+        duration = float(ffmpeg.probe(source_path)["format"]["duration"])
+    except (ffmpeg.Error, KeyError, ValueError):
+        duration = None
+
+    partial_path = get_partial_path(mp4_path)
+    command = ffmpeg.compile(
+        ffmpeg
+        .input(source_path)
+        .output(partial_path, format='mp4', vcodec='libx264', acodec='aac')
+        .global_args('-progress', 'pipe:1', '-nostats', '-loglevel', 'error')
+        .overwrite_output()
+    )
+    # stderr goes to a temp file so a noisy input can't fill a pipe and stall ffmpeg
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+        try:
+            for progress in parse_ffmpeg_progress(process.stdout, duration):
+                if cancel_event is not None and cancel_event.is_set():
+                    process.terminate()
+                    process.wait()
+                    raise JobCancelled(f"Transcode of {source_path} aborted")
+                if on_progress:
+                    on_progress(progress)
+            if process.wait() != 0:
+                stderr_file.seek(0)
+                raise ffmpeg.Error('ffmpeg', b'', stderr_file.read())
+            os.replace(partial_path, mp4_path)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
 def get_sibling_folders():
     """Get a list of sibling folders for navigation."""
     # Get the parent directory path from the video_dir
@@ -78,10 +304,25 @@ def get_original_webm_dir():
     """Return the path to the original WebM storage directory."""
     return os.path.join(config.video_dir, "original_webm")
 
+def archive_original_webm(webm_path, archived_name):
+    """Move an original WebM into the archive directory and track it in the artifact store."""
+    original_webm_dir = get_original_webm_dir()
+    os.makedirs(original_webm_dir, exist_ok=True)
+    archived_path = os.path.join(original_webm_dir, archived_name)
+    move_into_place(webm_path, archived_path)
+    artifact_store.add("original_webm", archived_path)
+    return archived_path
+
+def scan_artifacts():
+    """Register thumbnails and archived WebMs already on disk and enforce their budgets."""
+    artifact_store.scan("thumbnails", config.thumbnail_dir, ('.jpg',))
+    artifact_store.scan("original_webm", get_original_webm_dir(), ('.webm',))
+    artifact_store.enforce("thumbnails")
+    artifact_store.enforce("original_webm")
+
 def process_existing_webm_files():
     """Process existing WebM files and convert them to MP4 format."""
     init_db()  # Make sure database exists
-    db = load_db()
     original_webm_dir = get_original_webm_dir()
     os.makedirs(original_webm_dir, exist_ok=True)
 
@@ -89,46 +330,50 @@ def process_existing_webm_files():
         if filename.lower().endswith(".webm"):
             webm_path = os.path.join(config.video_dir, filename)
             base_name = os.path.splitext(filename)[0]
+
+            # Skip the transcode if the same bytes were already ingested
+            content_hash = hash_file(webm_path)
+            duplicate = find_duplicate_video(content_hash)
+            if duplicate and duplicate["path"] != filename:
+                link_duplicate(duplicate, filename)
+                archive_original_webm(webm_path, get_unique_filename(filename, original_webm_dir))
+                continue
+
             video_id = str(uuid.uuid4())
             mp4_filename = f"{video_id}.mp4"
             mp4_path = os.path.join(config.video_dir, mp4_filename)
 
             # Check if MP4 already exists
             if os.path.exists(mp4_path):
-                unique_name = get_unique_filename(filename, original_webm_dir)
-                shutil.move(webm_path, os.path.join(original_webm_dir, unique_name))
+                archive_original_webm(webm_path, get_unique_filename(filename, original_webm_dir))
                 continue
 
             # Convert WebM to MP4
             try:
-                (
-                    ffmpeg
-                    .input(webm_path)
-                    .output(mp4_path, vcodec='libx264', acodec='aac')
-                    .run(capture_stdout=True, capture_stderr=True)
-                )
+                transcode_to_mp4(webm_path, mp4_path)
                 
                 # Move original WebM to archive
                 unique_name = get_unique_filename(filename, original_webm_dir)
-                original_webm_path = os.path.join(original_webm_dir, unique_name)
-                shutil.move(webm_path, original_webm_path)
+                archive_original_webm(webm_path, unique_name)
                 
-                # Check if the video has audio
-                has_audio = has_audio_stream(mp4_path)
+                # Probe once and cache the media info
+                media = probe_media(mp4_path)
+                has_audio = media["has_audio"] if media else False
                 
                 # Create database entry
                 creation_time = datetime.datetime.now().isoformat()
-                db["videos"].append({
+                add_video_to_db({
                     "id": video_id,
                     "title": base_name,
                     "path": mp4_filename,
                     "has_audio": has_audio,
+                    "media": media,
                     "creation_date": creation_time,
                     "description": "",
                     "tags": [],
-                    "original_webm": unique_name
+                    "original_webm": unique_name,
+                    "content_hash": content_hash
                 })
-                save_db(db)
                 
                 # Generate thumbnail
                 generate_thumbnail(mp4_path, os.path.join(config.thumbnail_dir, video_id), has_audio)
@@ -151,33 +396,89 @@ def get_unique_filename(original_filename, directory):
     return filename
 
 def create_thumbnails_on_startup():
-    """Generate thumbnails for all videos in the database if they don't exist."""
+    """Generate thumbnails for all videos in the database if they don't exist.
+
+    Thumbnails evicted by the artifact store are left to be regenerated on
+    demand when next requested. Also backfills the media info cache for
+    entries that are missing or stale.
+    """
     db = load_db()
+    videos = [
+        video for video in db["videos"]
+        if os.path.exists(os.path.join(config.video_dir, video["path"]))
+    ]
+
+    # Backfill media info first and merge just those fields into the current catalog
+    media_updates = {}
+    for video in videos:
+        video_path = os.path.join(config.video_dir, video["path"])
+        if not is_media_cache_valid(video, video_path):
+            media = get_media_info(video, video_path, persist=False)
+            if media:
+                media_updates[video["id"]] = {"media": media, "has_audio": media["has_audio"]}
+    update_videos_in_db(media_updates)
     
-    for video in db["videos"]:
+    for video in videos:
         video_path = os.path.join(config.video_dir, video["path"])
         thumbnail_path = os.path.join(config.thumbnail_dir, f"{video['id']}.jpg")
         
-        if os.path.exists(video_path) and not os.path.exists(thumbnail_path):
-            has_audio = video.get("has_audio", has_audio_stream(video_path))
-            generate_thumbnail(video_path, os.path.join(config.thumbnail_dir, video["id"]), has_audio)
+        if not os.path.exists(thumbnail_path) and not artifact_store.was_evicted(thumbnail_path):
+            media = video.get("media")
+            has_audio = media["has_audio"] if media else video.get("has_audio", False)
+            generate_thumbnail(
+                video_path,
+                os.path.join(config.thumbnail_dir, video["id"]),
+                has_audio,
+                time=video.get("thumbnail_time", "00:00:01")
+            )
 
 def migrate_existing_videos():
-    """Migrate existing videos to the database if they're not already there."""
+    """Migrate existing videos to the database if they're not already there.
+
+    WebM files are left to process_existing_webm_files, which hashes them
+    once and converts them before they are added.
+    """
     db = load_db()
-    # Create a set of paths that are already in the database
-    existing_paths = {video["path"] for video in db["videos"]}
+    # Create a set of paths that are already in the database (or linked as duplicates)
+    existing_paths = set()
+    hash_updates = {}
+    for video in db["videos"]:
+        existing_paths.add(video["path"])
+        existing_paths.update(video.get("duplicate_sources", []))
+
+        # Backfill content hashes for entries ingested before hashing existed.
+        # New ingests hash the source bytes, so prefer the archived original WebM.
+        if video.get("content_hash"):
+            continue
+        source_path = os.path.join(config.video_dir, video["path"])
+        if video.get("original_webm"):
+            original_webm_path = os.path.join(get_original_webm_dir(), video["original_webm"])
+            if os.path.exists(original_webm_path):
+                source_path = original_webm_path
+        if os.path.exists(source_path):
+            hash_updates[video["id"]] = {"content_hash": hash_file(source_path)}
+
+    # Hashing can take a while; merge into a fresh load rather than saving the old snapshot
+    update_videos_in_db(hash_updates)
     
     for file in os.listdir(config.video_dir):
-        if file.lower().endswith(('.mp4', '.webm')) and file not in existing_paths:
+        if file.lower().endswith('.mp4') and file not in existing_paths:
+            # Link copies of already-ingested files instead of adding them again
+            content_hash = hash_file(os.path.join(config.video_dir, file))
+            duplicate = find_duplicate_video(content_hash)
+            if duplicate:
+                link_duplicate(duplicate, file)
+                continue
+
             # This video is not in the database, add it
             video_id = str(uuid.uuid4())
             creation_time = datetime.datetime.fromtimestamp(
                 os.path.getctime(os.path.join(config.video_dir, file))
             ).isoformat()
             
-            # Check if the video has audio
-            has_audio = has_audio_stream(os.path.join(config.video_dir, file))
+            # Probe once and cache the media info
+            media = probe_media(os.path.join(config.video_dir, file))
+            has_audio = media["has_audio"] if media else False
             
             # Add to database
             add_video_to_db({
@@ -189,7 +490,9 @@ def migrate_existing_videos():
                 "creation_date": creation_time,
                 "description": "",
                 "tags": [],
-                "has_audio": has_audio
+                "has_audio": has_audio,
+                "media": media,
+                "content_hash": content_hash
             })
             
             # Generate thumbnail if it doesn't exist
@@ -214,14 +517,18 @@ def get_video_files(sort_by="newest"):
         if os.path.exists(video_path):
             thumbnail_path = f"/thumbnails/{video['id']}.jpg"
             thumbnail_exists = os.path.exists(os.path.join(config.thumbnail_dir, f"{video['id']}.jpg"))
+            media = video.get("media") or {}
             
             video_files.append({
                 "id": video["id"],
                 "title": video["title"],
                 "path": video["path"],
-                "thumbnail": thumbnail_path if thumbnail_exists else None,
+                "thumbnail": thumbnail_path,  # Evicted thumbnails are regenerated on request
                 "has_thumbnail": thumbnail_exists,
                 "has_audio": video.get("has_audio", True),
+                "duration": media.get("duration"),
+                "width": media.get("width"),
+                "height": media.get("height"),
                 "creation_date": video.get("creation_date"),
                 "description": video.get("description", ""),
                 "tags": video.get("tags", [])